@@ -63,15 +63,30 @@ disqus_shortname=${disqus_shortname:-""}
 # arbitrary list of extensions we'll assume are video files.
 video_extensions=(3g2 3gp 3gp2 asf avi dvr-ms exr ffindex ffpreset flv gxf h261 h263 h264 h265 ifv m2t m2ts mts m4v mkv mod mov mp4 mpg mxf tod vob webm wmv y4m)
 
+# extensions we know are not videos, these are skipped without probing the file type
+ignore_extensions=(txt md markdown html htm css js json xml yml yaml sh ini log pdf zip cube 3dl dat m3d look xmp db ds_store)
+
 sequence_keyword=${sequence_keyword:-"imagesequence"} # if a directory name contains this keyword, treat it as an image sequence and compile it into a video
 sequence_framerate=${sequence_framerate:-24} # sequence framerat
 
 # specific codec options here
 h264_encodespeed=${h264_encodespeed:-"veryslow"} # h264 encode speed, slower produces better compression results. Options are ultrafast,superfast, veryfast, faster, fast, medium, slow, slower, veryslow
 vp9_encodespeed=${vp9_encodespeed:-1} # VP9 encode speed, 0 is best and slowest, 4 for fastest. VP9 is very slow to encode in general. Note that 0 is dramatically slower than 1 with marginal quality improvement
+adaptive_encodespeed=${adaptive_encodespeed:-false} # use faster software encoder settings for the large video resolutions: at most fast (h264/h265) or speed 4 (VP9) at 3840 wide and up, medium or speed 2 at 1920 and up. Smaller resolutions keep the settings above
+single_pass=${single_pass:-false} # encode h264, h265, vp9 and vp8 in a single constant quality pass capped at the target bitrate, instead of 2 passes. Roughly twice as fast, file sizes are less predictable. Always used when only one resolution is configured
 
 ffmpeg_threads=${ffmpeg_threads:-0} # the -threads option for ffmpeg encode (0=auto). This could be useful, for example if you need to throttle CPU load on a server that's doing other things.
 
+hardware_encode=${hardware_encode:-false} # encode h264 and h265 on the GPU (NVENC, Quick Sync, VAAPI or VideoToolbox) when ffmpeg supports it. Much faster, but single pass and usually lower quality at the same bitrate
+vaapi_device=${vaapi_device:-"/dev/dri/renderD128"} # render device used by the VAAPI encoder
+
+cascade_scale=${cascade_scale:-false} # scale each video resolution from the next larger one rather than from the source. Faster for large sources, at the cost of resampling the smaller sizes twice
+
+encode_jobs=${encode_jobs:-0} # number of images/videos to encode at the same time (0=one per CPU core). When running several at once, ffmpeg_threads=0 is lowered so the encodes share the cores instead of competing for them
+video_jobs=${video_jobs:-1} # of those, how many can be videos or image sequences. Each one runs every format and resolution at once, which takes a lot of memory for large videos
+
+use_vips=${use_vips:-true} # resize images with libvips (vipsthumbnail) when it is installed. It decodes at a reduced size and streams the image, so it is much faster and leaner than ImageMagick. Images with image-options are always done in ImageMagick
+
 # script starts here
 
 command -v convert >/dev/null 2>&1 || { echo "ImageMagick is a required dependency, aborting..." >&2; exit 1; }
@@ -82,7 +97,7 @@ video_format_extensions=("h264" "mp4" "h265" "mp4" "vp9" "webm" "vp8" "webm" "og
 
 draft=false
 # the -d flag has been set
-while getopts ":d" opt; do
+while getopts ":dj:c" opt; do
   case "$opt" in
     d)
 		echo "Draft mode On"
@@ -93,12 +108,91 @@ while getopts ":d" opt; do
 		video_formats=(h264)
 		download_button=false
 		;;
+    j)
+		encode_jobs="$OPTARG"
+		;;
+    c)
+		cascade_scale=true
+		;;
     \?)
       echo "Invalid option: -$OPTARG" >&2
       ;;
+    :)
+      echo "Option -$OPTARG requires an argument" >&2
+      ;;
   esac
 done
 
+cpu_count=$(getconf _NPROCESSORS_ONLN 2>/dev/null || sysctl -n hw.ncpu 2>/dev/null || echo 1)
+
+# a non-numeric job count (eg. -j auto) falls back to one per CPU core, leading zeros are dropped so the count isn't read as octal
+case "$encode_jobs" in
+	''|*[!0-9]*)
+		echo "Invalid number of jobs: $encode_jobs, using one per CPU core" >&2
+		encode_jobs=0
+		;;
+	*)
+		encode_jobs=$((10#$encode_jobs))
+		;;
+esac
+
+if [ "$encode_jobs" -lt 1 ]
+then
+	encode_jobs="$cpu_count"
+fi
+
+case "$video_jobs" in
+	''|*[!0-9]*|0)
+		video_jobs=1
+		;;
+	*)
+		video_jobs=$((10#$video_jobs))
+		;;
+esac
+
+# sort the resolutions from largest to smallest and drop duplicates once, keeping each one's bitrate. Resolutions without a bitrate get the last one given
+resolutions_sorted=$(for j in "${!resolution[@]}"; do echo "${resolution[j]} ${bitrate[j]:-${bitrate[${#bitrate[@]}-1]}}"; done | sort -s -k1,1nr -u)
+resolution=()
+bitrate=()
+while read -r res mbit
+do
+	resolution+=("$res")
+	bitrate+=("$mbit")
+done <<< "$resolutions_sorted"
+
+if [ "${#resolution[@]}" -eq 1 ]
+then
+	single_pass=true
+fi
+
+# look up the file extension of each video format once, aligned with video_formats[]
+video_formats_extension=()
+for f in "${!video_formats[@]}"
+do
+	for k in "${!video_format_extensions[@]}"
+	do
+		if [ "${video_format_extensions[k]}" = "${video_formats[f]}" ]
+		then
+			video_formats_extension[f]="${video_format_extensions[k+1]}"
+			break
+		fi
+	done
+done
+
+# ffmpeg threads are shared out between the running encodes, unless a thread count is configured
+auto_threads=false
+if [ "$ffmpeg_threads" = 0 ]
+then
+	auto_threads=true
+fi
+
+# wait -n is only available from bash 4.3, older versions poll for a free encode slot instead
+wait_any=false
+if [ "${BASH_VERSINFO[0]}" -gt 4 ] || { [ "${BASH_VERSINFO[0]}" -eq 4 ] && [ "${BASH_VERSINFO[1]}" -ge 3 ]; }
+then
+	wait_any=true
+fi
+
 video_enabled=false
 if command -v ffmpeg >/dev/null 2>&1 && command -v ffprobe >/dev/null 2>&1
 then
@@ -107,11 +201,62 @@ else
 	echo "FFmpeg not found, videos will not be processed"
 fi
 
+vips_enabled=false
+if [ "$use_vips" = true ] && command -v vipsthumbnail >/dev/null 2>&1
+then
+	vips_enabled=true
+fi
+
+# look the tools up in $PATH once, the background probe and encode jobs inherit the resolved paths
+hash convert identify
+[ "$video_enabled" = true ] && hash ffmpeg ffprobe
+[ "$vips_enabled" = true ] && hash vipsthumbnail
+
+# hardware encoders to use instead of libx264 and libx265. Builds list encoders whether or not the hardware is there,
+# so each family is checked with a one frame test encode before it is used
+hwencoder="" # nvenc, qsv, vaapi or videotoolbox
+h264_hwencoder=""
+h265_hwencoder=""
+
+# $1: encoder name, succeeds if it can encode a frame on this machine
+hwencoder_works () {
+	if [[ "$1" == *_vaapi ]]
+	then
+		ffmpeg -loglevel quiet -nostdin -vaapi_device "$vaapi_device" -f lavfi -i color=s=256x256 -frames:v 1 -vf format=nv12,hwupload -c:v "$1" -f null - 2>/dev/null
+	else
+		ffmpeg -loglevel quiet -nostdin -f lavfi -i color=s=256x256 -frames:v 1 -pix_fmt yuv420p -c:v "$1" -f null - 2>/dev/null
+	fi
+}
+
+if [ "$video_enabled" = true ] && [ "$hardware_encode" = true ]
+then
+	encoders=$(ffmpeg -hide_banner -encoders 2>/dev/null)
+	for e in nvenc qsv vaapi videotoolbox
+	do
+		if [[ "$encoders" == *" h264_$e "* ]] && hwencoder_works "h264_$e"
+		then
+			hwencoder="$e"
+			h264_hwencoder="h264_$e"
+			if [[ "$encoders" == *" hevc_$e "* ]] && hwencoder_works "hevc_$e"
+			then
+				h265_hwencoder="hevc_$e"
+			fi
+			echo "Using hardware encoder $e"
+			break
+		fi
+	done
+	
+	if [ -z "$hwencoder" ]
+	then
+		echo "No working hardware encoder found, using libx264/libx265" >&2
+	fi
+fi
+
 if [ "$autorotate" = true ]
 then
-	autorotateoption=" -auto-orient "
+	autorotateoption=(-auto-orient)
 else
-	autorotateoption=""
+	autorotateoption=()
 fi
 
 # directory structure will form nav structure
@@ -121,9 +266,13 @@ nav_depth=() # depth of each navigation item
 nav_type=() # 0 = structure, 1 = leaf. Where a leaf directory is a gallery of images
 nav_url=() # a browser-friendly url for each path, relative to _site
 nav_count=() # the number of images in each gallery, or -1 if not a leaf
+nav_first_gallery=() # index into the gallery arrays of the first image in each gallery
 
 metadata_file="metadata.txt" # search for this file in each gallery directory for gallery-wide metadata
 
+cache_file="_expose_cache.txt" # palettes and dimensions of each file, reused on the next run if the file is unchanged
+cache="" # cache entries for this run, one line of path|mtime|size|orientation|width|height|palette per file
+
 gallery_files=() # a flat list of all gallery images and videos
 gallery_nav=() # index of nav item the gallery image belongs to
 gallery_url=() # url-friendly name of each image
@@ -131,6 +280,9 @@ gallery_type=() # 0 = image, 1 = video, 2 = image sequence
 gallery_maxwidth=() # maximum image size available
 gallery_maxheight=() # maximum height
 gallery_colors=() # extracted color palette for each image
+gallery_width=() # width of the source image as stored, before any autorotation
+gallery_probe=() # orientation|width|height|palette of each file, empty while it is being probed in the background
+gallery_cachekey=() # path|mtime|size of each file, the key of its cache entry
 
 gallery_image_options=() # image commands extracted from post metadata
 gallery_video_options=() # video commands extracted from post metadata
@@ -139,9 +291,16 @@ gallery_video_filters=() # filter commands added to ffmpeg calls
 # scan working directory to populate $nav variables
 root_depth=$(echo "$topdir" | awk -F"/" "{ print NF }")
 
+# look up cygpath once, winpath is called for every file
+cygpath_enabled=false
+if command -v cygpath >/dev/null 2>&1
+then
+	cygpath_enabled=true
+fi
+
 # if on cygwin, transforms given param to windows style path
 winpath () {
-	if command -v cygpath >/dev/null 2>&1
+	if [ "$cygpath_enabled" = true ]
 	then
 		cygpath -m "$1"
 	else
@@ -149,12 +308,125 @@ winpath () {
 	fi
 }
 
-# $1: template, $2: {{ variable name }}, $3: replacement string
+# lists the images of an image sequence directory $1 in order, one per line
+# the glob comes back sorted and the extensions are matched in the shell, so no find or sort is needed
+sequence_frames () {
+	for frame in "$1"/*
+	do
+		case "$frame" in
+			*.[jJ][pP][gG]|*.[jJ][pP][eE][gG]|*.[gG][iI][fF]|*.[pP][nN][gG])
+				[ -f "$frame" ] && echo "$frame"
+				;;
+		esac
+	done
+}
+
+# lowercases $1, with the shell's own case conversion where available (bash 4+)
+lowercase () {
+	if [ "${BASH_VERSINFO[0]}" -ge 4 ]
+	then
+		echo "${1,,}"
+	else
+		echo "$1" | tr '[:upper:]' '[:lower:]'
+	fi
+}
+
+# turns $1 into a url-friendly name: only letters, digits and spaces are kept, spaces become dashes
+url_safe () {
+	url_name="${1//[^ abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789]/}"
+	lowercase "${url_name// /-}"
+}
+
+# blocks until fewer than $encode_jobs background jobs are running
+wait_for_slot () {
+	while [ "$(jobs -rp | wc -l)" -ge "$encode_jobs" ]
+	do
+		if [ "$wait_any" = true ]
+		then
+			wait -n
+		else
+			sleep 0.2
+		fi
+	done
+}
+
+# blocks until fewer than $video_jobs of the videos started, $video_pids, are still running
+wait_for_video_slot () {
+	while true
+	do
+		running_pids=" $(jobs -rp | tr '\n' ' ')"
+		running_videos=0
+		for pid in "${video_pids[@]}"
+		do
+			[[ "$running_pids" == *" $pid "* ]] && ((running_videos++))
+		done
+		
+		[ "$running_videos" -lt "$video_jobs" ] && break
+		
+		if [ "$wait_any" = true ]
+		then
+			wait -n
+		else
+			sleep 0.2
+		fi
+	done
+}
+
+# $1: format, $2: source file path, $3: image to read (for a video, the frame is extracted here first), $4: output file
+# writes orientation|width|height|palette of a single gallery item, palette colors are space separated
+probe_item () {
+	image="$3"
+	
+	if [ "$1" = "video" ]
+	then
+		ffmpeg -loglevel error -nostdin -y -i "$2" -vf "select=gte(n\,1)" -vframes 1 -qscale:v 2 "$(winpath "$image")"
+	fi
+	
+	palette=""
+	if [ "$extract_colors" = true ]
+	then
+		# the palette only needs a 200px thumbnail, so let libjpeg decode at a fraction of the full size
+		palette=$(convert -define jpeg:size=400x400 "$image" -resize 200x200 -depth 4 +dither -colors 7 -unique-colors txt:- | awk 'NR > 1 { for (f = 1; f <= NF; f++) if ($f ~ /^#/) { print $f; break } }' 2>&1)
+	fi
+	
+	# read orientation and dimensions with a single identify, -ping only reads the image header
+	IFS='|' read -r orientation width height < <(identify -ping -format "%[EXIF:Orientation]|%w|%h\n" "$image" | head -n 1)
+	
+	echo "$orientation|$width|$height|${palette//$'\n'/ }" > "$4"
+}
+
+# $1: template, followed by any number of $2: {{ variable name }}, $3: replacement string pairs
+# all pairs are substituted in a single sed pass, in the order given
 template () {
-	key=$(echo "$2" | tr -d '[:space:]')
+	text="$1"
+	shift
+	
+	script=""
+	while [ "$#" -gt 1 ]
+	do
+		key="${1//[[:space:]]/}"
+		
+		# collapse whitespace like an unquoted echo would, without expanding globs
+		set -f
+		words=($2)
+		set +f
+		value="${words[*]}"
 		
-	value=$(echo $3 | sed -e 's/\\/\\\\/g' -e 's/\//\\\//g' -e 's/&/\\\&/g') # escape sed input
-	echo "$1" | sed "s/{{$key}}/$value/g; s/{{$key:[^}]*}}/$value/g"
+		# escape sed input
+		value="${value//\\/\\\\}"
+		value="${value//\//\\/}"
+		value="${value//&/\\&}"
+		
+		script+="s/{{$key}}/$value/g; s/{{$key:[^}]*}}/$value/g; "
+		shift 2
+	done
+	
+	echo "$text" | sed "$script"
+}
+
+# filters a finished page: set default values for {{XXX:default}} strings, then remove references to any unused {{xxx}} template variables and empty <ul>s from navigation
+template_finish () {
+	sed "s/{{[^{}]*:\([^}]*\)}}/\1/g; s/{{[^}]*}}//g; s/<ul><\/ul>//g"
 }
 
 scratchdir=$(mktemp -d 2>/dev/null || mktemp -d -t 'exposetempdir')
@@ -170,6 +442,10 @@ chmod -R 740 "$scratchdir"
 output_url=""
 
 cleanup() {
+	# stop any encodes still running in the background
+	kill $(jobs -p) 2>/dev/null
+	wait
+	
 	# remove any ffmpeg log/temp files
 	rm -f ffmpeg*.log
 	rm -f ffmpeg*.mbtree
@@ -201,7 +477,9 @@ do
 		continue
 	fi
 	
-	node_depth=$(echo "$node" | awk -F"/" "{ print NF-$root_depth }")
+	# depth is the number of path separators below topdir
+	node_slashes="${node//[^\/]/}"
+	node_depth=$((${#node_slashes}+1-root_depth))
 
 	# ignore hidden directories
 	if [[ "$node" == "$topdir/."* ]]
@@ -215,14 +493,27 @@ do
 		continue
 	fi
 	
-	node_name=$(basename "$node" | sed -e 's/^[0-9]*//' | sed -e 's/^[[:space:]]*//;s/[[:space:]]*$//')
+	# strip numerical prefix and surrounding whitespace from the directory name
+	node_basename="${node##*/}"
+	node_name="${node_basename#"${node_basename%%[!0-9]*}"}"
+	node_name="${node_name#"${node_name%%[![:space:]]*}"}"
+	node_name="${node_name%"${node_name##*[![:space:]]}"}"
 	if [ -z "$node_name" ]
 	then
-		node_name=$(basename "$node")
+		node_name="$node_basename"
 	fi
-		
-	dircount=$(find "$node" -maxdepth 1 -type d ! -path "$node" ! -path "$node*/_*" | wc -l)
-	dircount_sequence=$(find "$node" -maxdepth 1 -type d ! -path "$node" ! -path "$node*/_*" ! -path "$node/*$sequence_keyword*" | wc -l)
+	
+	# list subdirectories once and count the non-imagesequence ones from that list
+	dircount=0
+	dircount_sequence=0
+	while read subdir
+	do
+		((dircount++))
+		if [[ "${subdir##*/}" != *"$sequence_keyword"* ]]
+		then
+			((dircount_sequence++))
+		fi
+	done < <(find "$node" -mindepth 1 -maxdepth 1 -type d ! -name "_*")
 	
 	if [ "$dircount" -gt 0 ]
 	then
@@ -233,7 +524,7 @@ do
 			node_type=1 # dir contains other dirs, but they are imagesequence dirs which are not galleries
 		fi
 	else
-		if [ ! -z "$sequence_keyword" ] && [ $(echo "$node_name" | grep "$sequence_keyword" | wc -l) -gt 0 ]
+		if [ ! -z "$sequence_keyword" ] && [[ "$node_name" == *"$sequence_keyword"* ]]
 		then
 			continue # dir is an imagesequence dir, it is in effect a video. Do not add to the path list
 		else
@@ -284,7 +575,7 @@ do
 		fi
 	fi
 	
-	url_rel=$(echo "${nav_name[$i]}" | sed 's/[^ a-zA-Z0-9]//g;s/ /-/g' | tr '[:upper:]' '[:lower:]')
+	url_rel=$(url_safe "${nav_name[$i]}")
 	
 	url=""
 	for u in "${dir_stack[@]}"
@@ -300,6 +591,60 @@ done
 
 printf "\nReading files"
 
+# list the files of every gallery once with their modification time and size, and join them against the cache of the last run
+# each gallery gets a sorted list in the scratch directory, one hit|mtime|size|orientation|width|height|palette|path line per file
+# an image sequence is keyed on its first frame instead of its directory, which doesn't change when a frame is replaced
+if stat -c '%Y' / >/dev/null 2>&1
+then
+	statformat=(-c '%Y|%s|%n') # GNU
+else
+	statformat=(-f '%m|%z|%N') # BSD
+fi
+
+cachesrc="$topdir/$cache_file"
+[ -s "$cachesrc" ] || cachesrc=/dev/null
+
+: > "$scratchdir/dirs.txt"
+for i in "${!paths[@]}"
+do
+	if [ "${nav_type[i]}" -ge 1 ]
+	then
+		echo "$i|${paths[i]}" >> "$scratchdir/dirs.txt"
+		: > "$scratchdir/files-$i.txt"
+	fi
+done
+
+for i in "${!paths[@]}"
+do
+	if [ "${nav_type[i]}" -ge 1 ]
+	then
+		find "${paths[i]}" -maxdepth 1 ! -path "${paths[i]}" ! -path "${paths[i]}*/_*" | sort | while IFS= read -r entry
+		do
+			# the first frame is listed just before its sequence
+			if [ -d "$entry" ] && [[ "${entry##*/}" == *"$sequence_keyword"* ]]
+			then
+				frames=$(sequence_frames "$entry")
+				[ -n "$frames" ] && echo "${frames%%$'\n'*}"
+			fi
+			echo "$entry"
+		done
+	fi
+done | tr '\n' '\0' | xargs -0 stat "${statformat[@]}" 2>/dev/null | awk -v out="$scratchdir/files-" '
+	FILENAME == ARGV[1] { i = index($0, "|"); dirs[substr($0, i + 1)] = substr($0, 1, i - 1); next }
+	FILENAME == ARGV[2] { split($0, f, "|"); cache[f[1] "|" f[2] "|" f[3]] = f[4] "|" f[5] "|" f[6] "|" f[7]; next }
+	{
+		i = index($0, "|"); mtime = substr($0, 1, i - 1); rest = substr($0, i + 1)
+		i = index(rest, "|"); size = substr(rest, 1, i - 1); path = substr(rest, i + 1)
+		dir = path; sub(/\/[^\/]*$/, "", dir)
+		if (!(dir in dirs)) { frame = path; framedir = dir; framemtime = mtime; framesize = size; next } # first frame of the next sequence
+		key = path "|" mtime "|" size
+		if (framedir == path) { key = frame "|" framemtime "|" framesize; mtime = framemtime; size = framesize }
+		framedir = ""
+		file = out dirs[dir] ".txt"
+		if (file != last) { if (last != "") close(last); last = file }
+		print ((key in cache) ? "1|" mtime "|" size "|" cache[key] : "0|" mtime "|" size "||||") "|" path > file
+	}' "$scratchdir/dirs.txt" "$cachesrc" -
+
 # read in each file to populate $gallery variables
 for i in "${!paths[@]}"
 do
@@ -316,32 +661,37 @@ do
 	mkdir -p "$topdir"/_site/"$url"
 
 	index=0
+	mime_files=() # files of this directory and their types, probed once the first unknown extension is found
+	mime_types=()
 	
 	# loop over found files
-	while read file
+	while IFS='|' read -r cache_hit mtime size cached_orientation cached_width cached_height cached_palette file
 	do
 		
 		printf "."
 		
-		filename=$(basename "$file")
-		filedir=$(dirname "$file")
+		filename="${file##*/}"
 		filepath=$(winpath "$file")
 		
-		trimmed=$(echo "${filename%.*}" | sed -e 's/^[[:space:]0-9]*//;s/[[:space:]]*$//')
+		# strip numerical prefix and surrounding whitespace from the file name
+		trimmed="${filename%.*}"
+		trimmed="${trimmed#"${trimmed%%[![:space:]0-9]*}"}"
+		trimmed="${trimmed%"${trimmed##*[![:space:]]}"}"
 		
 		if [ -z "$trimmed" ]
 		then
-			trimmed=$(echo "${filename%.*}")
+			trimmed="${filename%.*}"
 		fi
 		
-		image_url=$(echo "$trimmed" | sed 's/[^ a-zA-Z0-9]//g;s/ /-/g' | tr '[:upper:]' '[:lower:]')
+		image_url=$(url_safe "$trimmed")
 		
-		if [ -d "$file" ] && [ $(echo "$filename" | grep "$sequence_keyword" | wc -l) -gt 0 ]
+		if [ -d "$file" ] && [[ "$filename" == *"$sequence_keyword"* ]]
 		then
 			format="sequence"
-			image=$(find "$file" -maxdepth 1 ! -path "$file" -iname "*.jpg" -o -iname "*.jpeg" -o -iname "*.gif" -o -iname "*.png" | sort | head -n 1)
+			frames=$(sequence_frames "$file")
+			image="${frames%%$'\n'*}"
 		else
-			extension=$(echo "${filename##*.}" | tr '[:upper:]' '[:lower:]')
+			extension=$(lowercase "${filename##*.}")
 		
 			# we'll trust that extensions aren't lying
 			if [ "$extension" = "jpg" ] || [ "$extension" = "jpeg" ] || [ "$extension" = "png" ] || [ "$extension" = "gif" ]
@@ -366,71 +716,83 @@ do
 				
 				if [ "$found" = false ]
 				then
-					LC_ALL=C file -ib "$filename" | grep video >/dev/null || continue # not image or video or sequence, ignore
+					for e in "${ignore_extensions[@]}"
+					do
+						if [ "$e" = "$extension" ]
+						then
+							continue 2 # text and other known files, no need to look inside
+						fi
+					done
+					
+					# a single file call probes every file in the directory, one path<tab>type line each
+					if [ "${#mime_files[@]}" -eq 0 ]
+					then
+						while IFS=$'\t' read -r mime_file mime_type
+						do
+							mime_files+=("$mime_file")
+							mime_types+=("$mime_type")
+						done < <(find "$dir" -maxdepth 1 -type f ! -path "$dir*/_*" -exec env LC_ALL=C file -i -F $'\t' {} +)
+					fi
+					
+					mimetype=""
+					for m in "${!mime_files[@]}"
+					do
+						if [ "${mime_files[m]}" = "$file" ]
+						then
+							mimetype="${mime_types[m]}"
+							break
+						fi
+					done
+					
+					[[ "$mimetype" == *video* ]] || continue # not image or video or sequence, ignore
 				fi
 				
 				format="video"
 			fi
 		fi
 		
+		n="${#gallery_files[@]}"
 		
-		if [ "$format" = "video" ]
-		then
-			# generate image from video file first
-			temppath=$(winpath "$scratchdir/temp.jpg")
-			
-			ffmpeg -loglevel error -nostdin -y -i "$filepath" -vf "select=gte(n\,1)" -vframes 1 -qscale:v 2 "$temppath" < /dev/null
-			image="$scratchdir/temp.jpg"
-						
-		elif [ "$format" != "sequence" ]
-		then
-			image="$file"
-		fi
-				
-		if [ "$extract_colors" = true ]
+		# reuse the palette and dimensions from the last run if the file hasn't changed since
+		gallery_cachekey[n]="$file|$mtime|$size"
+		if [ "$format" = "sequence" ] && [ -n "$image" ]
 		then
-			palette=$(convert "$image" -resize 200x200 -depth 4 +dither -colors 7 -unique-colors txt:- | tail -n +2 | awk 'BEGIN{RS=" "} /#/ {print}' 2>&1)
-		else
-			palette=""
-			for p in "${default_palette[@]}"
-			do
-				palette+="$p"$'\n'
-			done
+			gallery_cachekey[n]="$image|$mtime|$size"
 		fi
-		# If autorotate is enabled, and the EXIF orientation exists, and the orientation is between 5 and 8 (vertical codes)
-		orientation=$(identify -format "%[EXIF:Orientation]" "$image")
-		if [ "$autorotate" = true ] && [ -n "$orientation" ] && [ $orientation -ge 5 ] && [ $orientation -le 8 ]
+		
+		probe=""
+		if [ "$cache_hit" = 1 ]
 		then
-			# If the image is rotated, swap the height and width
-			width=$(identify -format "%h" "$image")
-			height=$(identify -format "%w" "$image")
-		else
-			width=$(identify -format "%w" "$image")
-			height=$(identify -format "%h" "$image")
+			if [ "$extract_colors" = false ] || [ -n "$cached_palette" ]
+			then
+				probe="$cached_orientation|$cached_width|$cached_height|$cached_palette"
+			fi
 		fi
-
-		maxwidth=0
-		maxheight=0
-		count=0
+		gallery_probe[n]="$probe"
 		
-		for res in "${resolution[@]}"
-		do
-			((count++))
-			# store max values for later use
-			if [ "$width" -ge "$res" ] && [ "$res" -gt "$maxwidth" ]
+		# otherwise probe the file in the background, the results are collected once every file has been read
+		if [ -z "$probe" ]
+		then
+			if [ "$format" = "video" ]
 			then
-				maxwidth="$res"
-				maxheight=$((res*height/width))
-			elif [ "$maxwidth" -eq 0 ] && [ "$count" = "${#resolution[@]}" ]
+				image="$scratchdir/frame-$n.jpg" # kept so the encode can reuse it as the poster image
+			elif [ "$format" != "sequence" ]
 			then
-				maxwidth="$res"
-				maxheight=$((res*height/width))
+				image="$file"
 			fi
-		done
-				
+			
+			wait_for_slot
+			probe_item "$format" "$filepath" "$image" "$scratchdir/probe-$n.txt" < /dev/null &
+		fi
+		
 		((index++))
 		
 		# store file and type for later use
+		if [ -z "${nav_first_gallery[i]}" ]
+		then
+			nav_first_gallery[i]="${#gallery_files[@]}"
+		fi
+		
 		gallery_files+=("$file")
 		gallery_nav+=("$i")
 		gallery_url+=("$image_url")
@@ -444,23 +806,82 @@ do
 		else
 			gallery_type+=(0)
 		fi
-		gallery_maxwidth+=("$maxwidth")
-		gallery_maxheight+=("$maxheight")
-		gallery_colors+=("$palette")
-	done < <(find "$dir" -maxdepth 1 ! -path "$dir" ! -path "$dir*/_*" | sort)
+	done < "$scratchdir/files-$i.txt"
 	
 	nav_count[i]="$index"
 done
 
-# build html file for each gallery
-template=$(cat "$scriptdir/$theme_dir/template.html")
-post_template=$(cat "$scriptdir/$theme_dir/post-template.html")
+# wait for the last probes, then fill in the dimensions and palette of each file
+wait
 
-gallery_index=0
-firsthtml=""
-firstpath=""
+for n in "${!gallery_files[@]}"
+do
+	probe="${gallery_probe[n]}"
+	if [ -z "$probe" ] && [ -s "$scratchdir/probe-$n.txt" ]
+	then
+		probe=$(cat "$scratchdir/probe-$n.txt")
+	fi
+	
+	IFS='|' read -r orientation width height palette <<< "$probe"
+	
+	if [ "$extract_colors" = true ]
+	then
+		cache+="${gallery_cachekey[n]}|$orientation|$width|$height|$palette"$'\n'
+		palette="${palette// /$'\n'}"
+	else
+		cache+="${gallery_cachekey[n]}|$orientation|$width|$height|"$'\n'
+		
+		palette=""
+		for p in "${default_palette[@]}"
+		do
+			palette+="$p"$'\n'
+		done
+	fi
+	
+	gallery_width[n]="$width"
+	
+	# If autorotate is enabled, and the EXIF orientation exists, and the orientation is between 5 and 8 (vertical codes)
+	if [ "$autorotate" = true ] && [ -n "$orientation" ] && [ $orientation -ge 5 ] && [ $orientation -le 8 ]
+	then
+		# If the image is rotated, swap the height and width
+		swap="$width"
+		width="$height"
+		height="$swap"
+	fi
 
-printf "\nBuilding HTML"
+	maxwidth=0
+	maxheight=0
+	count=0
+	
+	for res in "${resolution[@]}"
+	do
+		((count++))
+		# store max values for later use
+		if [ "$width" -ge "$res" ] && [ "$res" -gt "$maxwidth" ]
+		then
+			maxwidth="$res"
+			maxheight=$((res*height/width))
+		elif [ "$maxwidth" -eq 0 ] && [ "$count" = "${#resolution[@]}" ]
+		then
+			maxwidth="$res"
+			maxheight=$((res*height/width))
+		fi
+	done
+	
+	gallery_maxwidth[n]="$maxwidth"
+	gallery_maxheight[n]="$maxheight"
+	gallery_colors[n]="$palette"
+done
+
+# only keep entries for files that are still there
+printf "%s" "$cache" > "$topdir/$cache_file"
+
+printf "\nReading text"
+
+# read the text file of each image, split into metadata and content
+gallery_text_metadata=()
+gallery_content=()
+gallery_index=0
 
 for i in "${!paths[@]}"
 do
@@ -469,41 +890,35 @@ do
 		continue
 	fi
 	
-	html="$template"
-	
-	gallery_metadata=""
-	if [ -e "${paths[i]}/$metadata_file" ]
-	then
-		gallery_metadata=$(cat "${paths[i]}/$metadata_file")
-	fi
+	# list the gallery's text files once instead of searching for one per image
+	textfiles=$'\n'$(find "${paths[i]}" -maxdepth 1 -type f \( -name "*.txt" -o -name "*.md" \))$'\n'
 	
 	j=0
 	while [ "$j" -lt "${nav_count[i]}" ]
 	do
-	
 		printf "." # show progress
 		
-		k=$((j+1))
 		file_path="${gallery_files[gallery_index]}"
-		file_type="${gallery_type[gallery_index]}"
 		
 		# try to find a text file with the same name
-		filename=$(basename "$file_path")
+		filename="${file_path##*/}"
 		filename="${filename%.*}"
 
-		filedir=$(dirname "$file_path")
-		
-		type="image"
-		if [ "${gallery_type[gallery_index]}" -gt 0 ]
-		then
-			type="video"
-		fi
+		filedir="${file_path%/*}"
 		
-		textfile=$(find "$filedir/$filename".txt "$filedir/$filename".md ! -path "$file_path" -print -quit 2>/dev/null)
+		textfile=""
+		for extension in txt md
+		do
+			if [ "$filedir/$filename.$extension" != "$file_path" ] && [[ "$textfiles" == *$'\n'"$filedir/$filename.$extension"$'\n'* ]]
+			then
+				textfile="$filedir/$filename.$extension"
+				break
+			fi
+		done
 		
 		metadata=""
 		content=""
-		if LC_ALL=C file "$textfile" | grep -q text
+		if [ -n "$textfile" ] && LC_ALL=C file "$textfile" | grep -q text
 		then
 			# if there are two lines "---", the lines preceding the second "---" are assumed to be metadata
 			text=$(cat "$textfile" | tr -d $'\r')
@@ -523,43 +938,164 @@ do
 			fi
 		fi
 		
-		metadata+=$'\n'
-		metadata+="$gallery_metadata"
-		metadata+=$'\n'
-		z=1
-		while read line
-		do
-			# add generated palette to metadata
-			metadata="$metadata""color$z:$line"$'\n'
-			((z++))
-		done < <(echo "${gallery_colors[gallery_index]}")
-		
-		backgroundcolor=$(echo "${gallery_colors[gallery_index]}" | sed -n 2p)
-		if [ "$override_textcolor" = false ]
-		then
-			textcolor=$(echo "${gallery_colors[gallery_index]}" | tail -1)
-		fi
+		gallery_text_metadata[gallery_index]="$metadata"
+		gallery_content[gallery_index]="$content"
 		
-		# if perl available, pass content through markdown parser
-		if command -v perl >/dev/null 2>&1
-		then
-			content=$(perl "$scriptdir/Markdown_1.0.1/Markdown.pl" --html4tags <(echo "$content"))
-		fi
+		((gallery_index++))
+		((j++))
+	done
+done
+
+# if perl available, pass content through markdown parser
+# Markdown.pl is loaded once as a library and converts every post, posts are separated by NUL characters both ways
+if command -v perl >/dev/null 2>&1 && [ "${#gallery_content[@]}" -gt 0 ]
+then
+	gallery_index=0
+	while IFS= read -r -d '' content
+	do
+		gallery_content[gallery_index]="$content"
+		((gallery_index++))
+	done < <(printf '%s\n\0' "${gallery_content[@]}" | perl -e '
+		my $markdown = shift;
+		{
+			# loading the script runs its command line interface, let it set --html4tags and convert an empty file
+			local @ARGV = ("--html4tags", "/dev/null");
+			local *STDOUT;
+			open(STDOUT, ">", "/dev/null");
+			do $markdown or die "Could not load $markdown: $@";
+		}
 		
-		# write to post template
-		post=$(template "$post_template" index "$k")
+		my @posts = do { local $/ = "\0"; <STDIN> };
+		for my $text (@posts) {
+			$text =~ s/\0\z//;
+			print Markdown::Markdown($text), "\0";
+		}
+	' "$scriptdir/Markdown_1.0.1/Markdown.pl")
+fi
+
+# build html file for each gallery
+template=$(cat "$scriptdir/$theme_dir/template.html")
+post_template=$(cat "$scriptdir/$theme_dir/post-template.html")
+
+gallery_index=0
+firsthtml=""
+firstpath=""
+
+printf "\nBuilding HTML"
+
+# build main navigation once, each gallery page only marks its own entry as active
+navigation=""
+
+# write html menu in a single pass, paths are sorted so each entry directly follows its parent or siblings
+open=0 # number of entries whose child list is still open
+
+for j in "${!paths[@]}"
+do
+	if [ "$j" = 0 ]
+	then
+		continue
+	fi
+	
+	# close the entries that are not ancestors of this one
+	while [ "$open" -ge "${nav_depth[j]}" ]
+	do
+		navigation+="</ul></li>"
+		((open--))
+	done
+	
+	if [ "${nav_type[j]}" = 0 ]
+	then
+		navigation+="<li><span class=\"label\">${nav_name[j]}</span><ul>"
+	else
+		gindex="${nav_first_gallery[j]:-0}"
 		
-		post=$(template "$post" post "$content")
+		spacing=" "
+		if [ "${nav_depth[j]}" = 1 ]
+		then
+			spacing="  "
+		fi
 		
+		navigation+="<li class=\"gallery {{active$j}}\"$spacing""data-image=\"${gallery_url[gindex]}\"><a href=\"{{basepath}}${nav_url[j]}\"><span>${nav_name[j]}</span></a><ul>"
+	fi
+	((open++))
+done
+
+while [ "$open" -gt 0 ]
+do
+	navigation+="</ul></li>"
+	((open--))
+done
+
+for i in "${!paths[@]}"
+do
+	if [ "${nav_type[i]}" -lt 1 ]
+	then
+		continue
+	fi
+	
+	html="$template"
+	
+	gallery_metadata=""
+	if [ -e "${paths[i]}/$metadata_file" ]
+	then
+		gallery_metadata=$(cat "${paths[i]}/$metadata_file")
+	fi
+	
+	j=0
+	while [ "$j" -lt "${nav_count[i]}" ]
+	do
+	
+		printf "." # show progress
+		
+		k=$((j+1))
+		file_path="${gallery_files[gallery_index]}"
+		file_type="${gallery_type[gallery_index]}"
+		
+		type="image"
+		if [ "${gallery_type[gallery_index]}" -gt 0 ]
+		then
+			type="video"
+		fi
+		
+		metadata="${gallery_text_metadata[gallery_index]}"
+		content="${gallery_content[gallery_index]}"
+		
+		metadata+=$'\n'
+		metadata+="$gallery_metadata"
+		metadata+=$'\n'
+		z=1
+		palette=()
 		while read line
 		do
-			key=$(echo "$line" | cut -d ':' -f1 | tr -d $'\r\n' | sed -e 's/^[[:space:]]*//' -e 's/[[:space:]]*$//')
-			value=$(echo "$line" | cut -d ':' -f2- | tr -d $'\r\n' | sed -e 's/^[[:space:]]*//' -e 's/[[:space:]]*$//')
-			colon=$(echo "$line" | grep ':')
-
-			if [ "$key" ] && [ "$value" ] && [ "$colon" ]
+			# add generated palette to metadata
+			metadata="$metadata""color$z:$line"$'\n'
+			palette+=("$line")
+			((z++))
+		done <<< "${gallery_colors[gallery_index]}"
+		
+		backgroundcolor="${palette[1]}"
+		if [ "$override_textcolor" = false ]
+		then
+			textcolor="${palette[${#palette[@]}-1]}"
+		fi
+		
+		# write to post template, collecting every variable so the post is templated in one pass
+		subs=(index "$k" post "$content")
+		
+		while read line
+		do
+			# split and trim with parameter expansion, this runs for every metadata line
+			line="${line//$'\r'/}"
+			key="${line%%:*}"
+			key="${key#"${key%%[![:space:]]*}"}"
+			key="${key%"${key##*[![:space:]]}"}"
+			value="${line#*:}"
+			value="${value#"${value%%[![:space:]]*}"}"
+			value="${value%"${value##*[![:space:]]}"}"
+
+			if [ "$key" ] && [ "$value" ] && [[ "$line" == *:* ]]
 			then
-				post=$(template "$post" "$key" "$value")
+				subs+=("$key" "$value")
 				
 				if [ "$key" = "image-options" ]
 				then
@@ -576,117 +1112,52 @@ do
 					gallery_video_filters[gallery_index]="$value"
 				fi
 			fi
-		done < <(echo "$metadata")
+		done <<< "$metadata"
 		
 		# set image parameters
-		post=$(template "$post" imageurl "${gallery_url[gallery_index]}")
-		post=$(template "$post" imagewidth "${gallery_maxwidth[gallery_index]}")
+		subs+=(imageurl "${gallery_url[gallery_index]}")
+		subs+=(imagewidth "${gallery_maxwidth[gallery_index]}")
 		
-		post=$(template "$post" imageheight "${gallery_maxheight[gallery_index]}")
+		subs+=(imageheight "${gallery_maxheight[gallery_index]}")
 		
 		# set colors
-		post=$(template "$post" textcolor "$textcolor")
-		post=$(template "$post" backgroundcolor "$backgroundcolor")
+		subs+=(textcolor "$textcolor")
+		subs+=(backgroundcolor "$backgroundcolor")
 		
-		post=$(template "$post" type "$type")
+		subs+=(type "$type")
+		
+		post=$(template "$post_template" "${subs[@]}")
 
-		html=$(template "$html" content "$post {{content}}" true)
+		html=$(template "$html" content "$post {{content}}")
 		
 		((gallery_index++))
 		((j++))
 	done
 	
 	#write html file
-	html=$(template "$html" sitetitle "$site_title")
-	html=$(template "$html" gallerytitle "${nav_name[i]}")
+	subs=(sitetitle "$site_title")
+	subs+=(gallerytitle "${nav_name[i]}")
 	
-	html=$(template "$html" disqus_shortname "$disqus_shortname")
+	subs+=(disqus_shortname "$disqus_shortname")
 	
 	resolutionstring=$(printf "%s " "${resolution[@]}")
-	html=$(template "$html" resolution "$resolutionstring")
+	subs+=(resolution "$resolutionstring")
 	
 	formatstring=$(printf "%s " "${video_formats[@]}")
-	html=$(template "$html" videoformats "$formatstring")
+	subs+=(videoformats "$formatstring")
 	
 	display=$([ "$text_toggle" = true ] && echo "block" || echo "none")
-	html=$(template "$html" text_toggle "$display")
+	subs+=(text_toggle "$display")
 	
 	display=$([ "$social_button" = true ] && echo "block" || echo "none")
-	html=$(template "$html" social_button "$display")
+	subs+=(social_button "$display")
 	
 	display=$([ "$download_button" = true ] && echo "block" || echo "none")
-	html=$(template "$html" download_button "$display")
-	
-	# build main navigation
-	navigation=""
+	subs+=(download_button "$display")
 	
-	# write html menu via depth first search
-	depth=1
-	prevdepth=0
-	
-	remaining="${#paths[@]}"
-	parent=-1
-	
-	while [ "$remaining" -gt 1 ]
-	do
-		for j in "${!paths[@]}"
-		do
-			if [ "$depth" -gt 1 ] && [ "${nav_depth[j]}" = "$prevdepth" ]
-			then
-				parent="$j"
-			fi
-			
-			if [ "$i" = "$j" ]
-			then
-				active="active"
-			else
-				active=""
-			fi
-			
-			if [ "$parent" -lt 0 ] && [ "${nav_depth[j]}" = 1 ]
-			then
-				if [ "${nav_type[j]}" = 0 ]
-				then
-					navigation+="<li><span class=\"label\">${nav_name[j]}</span><ul>{{marker$j}}</ul></li>"
-				else
-					gindex=0
-					for k in "${!gallery_nav[@]}"
-					do
-						if [ "${gallery_nav[k]}" = "$j" ]
-						then
-							gindex="$k"
-							break
-						fi
-					done
-					navigation+="<li class=\"gallery $active\"  data-image=\"${gallery_url[gindex]}\"><a href=\"{{basepath}}${nav_url[j]}\"><span>${nav_name[j]}</span></a><ul>{{marker$j}}</ul></li>"
-				fi
-				((remaining--))
-			elif [ "${nav_depth[j]}" = "$depth" ]
-			then
-				if [ "${nav_type[j]}" = 0 ]
-				then
-					substring="<li><span class=\"label\">${nav_name[j]}</span><ul>{{marker$j}}</ul></li>{{marker$parent}}"
-				else
-					gindex=0
-					for k in "${!gallery_nav[@]}"
-					do
-						if [ "${gallery_nav[k]}" = "$j" ]
-						then
-							gindex="$k"
-							break
-						fi
-					done
-					substring="<li class=\"gallery $active\" data-image=\"${gallery_url[gindex]}\"><a href=\"{{basepath}}${nav_url[j]}\"><span>${nav_name[j]}</span></a><ul>{{marker$j}}</ul></li>{{marker$parent}}"
-				fi
-				navigation=$(template "$navigation" "marker$parent" "$substring")
-				((remaining--))
-			fi
-		done
-		((prevdepth++))
-		((depth++))
-	done
+	html=$(template "$html" "${subs[@]}")
 	
-	html=$(template "$html" navigation "$navigation")
+	html=$(template "$html" navigation "$navigation" "active$i" "active")
 	
 	if [ -z "$firsthtml" ]
 	then
@@ -701,14 +1172,7 @@ do
 		basepath=$(yes "../" | head -n ${nav_depth[i]} | tr -d '\n')
 	fi
 	
-	html=$(template "$html" basepath "$basepath")
-	html=$(template "$html" disqus_identifier "${nav_url[i]}")
-	
-	# set default values for {{XXX:default}} strings
-	html=$(echo "$html" | sed "s/{{[^{}]*:\([^}]*\)}}/\1/g")
-	
-	# remove references to any unused {{xxx}} template variables and empty <ul>s from navigation
-	html=$(echo "$html" | sed "s/{{[^}]*}}//g; s/<ul><\/ul>//g")
+	html=$(template "$html" basepath "$basepath" disqus_identifier "${nav_url[i]}" | template_finish)
 	
 	echo "$html" > "$topdir/_site/${nav_url[i]}"/index.html
 	
@@ -717,18 +1181,90 @@ done
 # write top level index.html
 
 basepath="./"
-firsthtml=$(template "$firsthtml" basepath "$basepath")
-firsthtml=$(template "$firsthtml" disqus_identifier "$firstpath")
-firsthtml=$(template "$firsthtml" resourcepath "$firstpath/")
-firsthtml=$(echo "$firsthtml" | sed "s/{{[^{}]*:\([^}]*\)}}/\1/g")
-firsthtml=$(echo "$firsthtml" | sed "s/{{[^}]*}}//g; s/<ul><\/ul>//g")
+firsthtml=$(template "$firsthtml" basepath "$basepath" disqus_identifier "$firstpath" resourcepath "$firstpath/" | template_finish)
 echo "$firsthtml" > "$topdir/_site"/index.html
 
-printf "\nStarting encode\n"
+# decode the input once and scale it to each output width, labelled [vN]. Outputs of the same width share a single scale and filter chain
+# with cascade_scale each width is scaled down from the next larger one instead of from the full size source
+# $1: filters applied after scaling, remaining args: N:width or N:width:filters for each output, the latter run after all other filters
+scale_graph () {
+	filters="$1"
+	shift
+	
+	widths=($(for output in "$@"; do width="${output#*:}"; echo "${width%%:*}"; done | sort -rnu))
+	
+	graph=""
+	source="[0:v]"
+	if [ "$cascade_scale" != true ] && [ "${#widths[@]}" -gt 1 ]
+	then
+		graph="[0:v]split=${#widths[@]}"
+		for width in "${widths[@]}"
+		do
+			graph+="[in$width]"
+		done
+		graph+=";"
+	fi
+	
+	for k in "${!widths[@]}"
+	do
+		width="${widths[k]}"
+		labels=""
+		chains=""
+		count=0
+		
+		for output in "$@"
+		do
+			n="${output%%:*}"
+			rest="${output#*:}"
+			[ "${rest%%:*}" = "$width" ] || continue
+			
+			if [[ "$rest" == *:* ]]
+			then
+				labels+="[t$n]"
+				chains+=";[t$n]${rest#*:}[v$n]"
+			else
+				labels+="[v$n]"
+			fi
+			((count++))
+		done
+		
+		chain="${filters#,}${filters:+,}split=$count$labels$chains"
+		
+		if [ "$cascade_scale" = true ]
+		then
+			graph+="${source}scale=$width:trunc(ow/a/2)*2,"
+			if [ "$k" -lt $(( ${#widths[@]}-1 )) ]
+			then
+				# keep an unfiltered copy to scale the next width from
+				source="[c$width]"
+				graph+="split=2$source[f$width];[f$width]"
+			fi
+		elif [ "${#widths[@]}" -gt 1 ]
+		then
+			graph+="[in$width]scale=$width:trunc(ow/a/2)*2,"
+		else
+			graph+="[0:v]scale=$width:trunc(ow/a/2)*2,"
+		fi
+		
+		graph+="$chain;"
+	done
+	
+	echo "${graph%;}"
+}
 
 # resize images, encode videos, compile image sequences
-for i in "${!gallery_files[@]}"
-do
+# $1: index into the gallery arrays, $2: scratch directory private to this item
+# runs in its own subshell so that several items can be encoded at once
+encode_item () {
+	i="$1"
+	workdir="$2"
+	output_url=""
+	output_urls=()
+	
+	# remove the private scratch directory and any partially written video on the way out
+	trap 'exit 1' INT TERM
+	trap 'rm -rf "$workdir"; rm -f "$output_url" "${output_urls[@]}"' EXIT
+	
 	echo -e "${gallery_url[i]}"
 	
 	navindex="${gallery_nav[i]}"
@@ -750,18 +1286,9 @@ do
 			do
 				res="${resolution[$j]}"
 				
-				for vformat in "${video_formats[@]}"
-				do				
-					videofile="$res-$vformat."
-					
-					for k in "${!video_format_extensions[@]}"
-					do
-						if [ "${video_format_extensions[k]}" = "$vformat" ]
-						then
-							videofile+="${video_format_extensions[k+1]}"
-							break
-						fi
-					done
+				for f in "${!video_formats[@]}"
+				do
+					videofile="$res-${video_formats[f]}.${video_formats_extension[f]}"
 					
 					if [ ! -s "$topdir/_site/$url/$videofile" ]
 					then
@@ -773,24 +1300,32 @@ do
 			
 			if [ "$seqfinished" = true ]
 			then
-				continue
+				return
 			fi
 			
 			echo "Compiling sequence images"
 			
-			# ffmpeg's image sequence feature is oddly limited and can't accept arbitrarily named files, copy to scratch dir as sequentially named files
+			# ffmpeg's image sequence feature is oddly limited and can't accept arbitrarily named files, link them into the scratch dir as sequentially named files
+			# native Windows ffmpeg can't follow Cygwin symlinks, so there the frames are hard linked, or copied if the scratch dir is on another drive
 			j=0
 			while read seqfile
 			do
-				tempname=$(printf "%04d" "$j")
-				cp "$seqfile" "$scratchdir/$tempname"
+				printf -v tempname "%04d" "$j"
+				if [ "$cygpath_enabled" = true ]
+				then
+					ln "$seqfile" "$workdir/$tempname" 2>/dev/null || cp "$seqfile" "$workdir/$tempname"
+				else
+					ln -s "$seqfile" "$workdir/$tempname"
+				fi
 				((j++))
-			done < <(find "$filepath" -maxdepth 1 ! -path "$filepath" -iname "*.jpg" -o -iname "*.jpeg" -o -iname "*.gif" -o -iname "*.png" | sort)
-			sequencevideo="$scratchdir/sequencevideo.mp4"
+			done < <(sequence_frames "$filepath")
 			
-			maxres=$(printf '%s\n' "${resolution[@]}" | sort -n | tail -n 1)
+			# the intermediate video is only read back once by the encode below, so it is stored losslessly with the fast FFV1 codec rather than compressed
+			sequencevideo="$workdir/sequencevideo.mkv"
 			
-			ffmpeg -loglevel error -nostdin -f image2 -y -i "$scratchdir/%04d" -c:v libx264 -threads "$ffmpeg_threads" -vf scale="$maxres:trunc(ow/a/2)*2" -profile:v high -pix_fmt yuv420p -preset "$h264_encodespeed" -crf 15 -r "$sequence_framerate" -f mp4 "$sequencevideo"
+			maxres="${resolution[0]}"
+			
+			ffmpeg -loglevel error -nostdin -f image2 -y -i "$workdir/%04d" -c:v ffv1 -level 3 -slices 16 -slicecrc 1 -threads "$ffmpeg_threads" -vf scale="$maxres:trunc(ow/a/2)*2" -pix_fmt yuv420p -r "$sequence_framerate" -f matroska "$sequencevideo"
 			
 			filepath="$sequencevideo"
 		fi
@@ -798,9 +1333,8 @@ do
 		filepath=$(winpath "$filepath")
 		
 		# use ffmpeg to encode h264 videos for each resolution
-		dimensions=$(ffprobe -v error -of flat=s=_ -select_streams v:0 -show_entries stream=width,height "$filepath")
-		width=$(echo "$dimensions" | sed -n 1p | cut -d '=' -f2 )
-		height=$(echo "$dimensions" | sed -n 2p | cut -d '=' -f2 )
+		# width and height come back as a single WIDTHxHEIGHT line
+		IFS='x' read -r width height < <(ffprobe -v error -of csv=p=0:s=x -select_streams v:0 -show_entries stream=width,height "$filepath" | head -n 1)
 		
 		options=""
 		if [ ! -z "${gallery_video_options[i]}" ]
@@ -812,14 +1346,14 @@ do
 		if [ ! -z "${gallery_video_filters[i]}" ]
 		then
 			filters=",${gallery_video_filters[i]}"
-			filtersfull="-vf ${gallery_video_filters[i]}"
 		fi
 		
+		# outputs of a filter graph only get the streams that are mapped explicitly, so audio is mapped along with the video
 		if [ "$disable_audio" = true ]
 		then
-			audio="-an"
+			audio=(-an)
 		else
-			audio="-c:a copy"
+			audio=(-map "0:a?" -c:a copy)
 		fi
 		
 		if [ "$draft" = true ]
@@ -827,102 +1361,246 @@ do
 			# if in draft mode, use single pass CRF coding with ultrafast preset
 			output_url=$(winpath "$topdir/_site/$url/${resolution[0]}-h264.mp4")
 			
-			[ -s "$output_url" ] && continue
+			if [ -s "$output_url" ]
+			then
+				output_url=""
+				return
+			fi
 			
-			ffmpeg -loglevel error -nostdin -i "$filepath" -c:v libx264 -threads "$ffmpeg_threads" $options -vf scale="${resolution[0]}:trunc(ow/a/2)*2$filters" -profile:v high -pix_fmt yuv420p -preset ultrafast -crf 26 $audio -movflags +faststart -f mp4 "$output_url"
+			ffmpeg -loglevel error -nostdin -i "$filepath" -c:v libx264 -threads "$ffmpeg_threads" $options -vf scale="${resolution[0]}:trunc(ow/a/2)*2$filters" -map 0:v:0 -profile:v high -pix_fmt yuv420p -preset ultrafast -crf 26 "${audio[@]}" -movflags +faststart -f mp4 "$output_url"
 		else
-			for vformat in "${video_formats[@]}"
+			# collect every format and resolution still to be encoded, so the source is decoded once per pass for all of them
+			targets=() # index into resolution[] of each output
+			targets_format=()
+			output_urls=()
+			
+			# resolutions the source is large enough for, and the height each one scales to
+			scaled=()
+			for j in "${!resolution[@]}"
 			do
-				firstpass=false
-				for j in "${!resolution[@]}"
-				do					
+				if [ "$width" -ge "${resolution[$j]}" ]
+				then
+					scaled+=("$j")
+					scaled_heights[j]=$(( height*resolution[j]/width ))
+				fi
+			done
+			
+			for f in "${!video_formats[@]}"
+			do
+				vformat="${video_formats[f]}"
+				for j in "${scaled[@]}"
+				do
 					res="${resolution[$j]}"
-					if [ "$width" -ge "$res" ]
+					videofile="$res-$vformat.${video_formats_extension[f]}"
+					
+					[ -s "$topdir/_site/$url/$videofile" ] && continue
+					
+					echo -e "\tEncoding $vformat $res x ${scaled_heights[j]}"
+					
+					targets+=("$j")
+					targets_format+=("$vformat")
+					output_urls+=("$(winpath "$topdir/_site/$url/$videofile")")
+				done
+			done
+			
+			if [ "${#targets[@]}" -gt 0 ]
+			then
+				firstpass=() # ffmpeg outputs for the first pass of 2 pass encodes, only the pass statistics are kept
+				secondpass=() # ffmpeg outputs for the final encodes
+				firstpass_scales=()
+				secondpass_scales=()
+				
+				# every output is a separate encoder in the same ffmpeg process, so the item's threads are split between them
+				output_threads="$ffmpeg_threads"
+				if [ "$ffmpeg_threads" -gt 0 ]
+				then
+					output_threads=$(( ffmpeg_threads / ${#targets[@]} ))
+					[ "$output_threads" -lt 1 ] && output_threads=1
+				fi
+				
+				for n in "${!targets[@]}"
+				do
+					j="${targets[n]}"
+					vformat="${targets_format[n]}"
+					res="${resolution[$j]}"
+					mbit="${bitrate[$j]}"
+					mbitmax=$(( mbit*bitrate_maxratio ))
+					
+					rate=(-b:v "$mbit"M -maxrate "$mbitmax"M -bufsize "$mbitmax"M)
+					upload="" # filters to move frames onto the GPU
+					
+					twopass=true
+					pass1=(-pass 1 -passlogfile "$workdir/ffmpeg2pass-$n") # each output gets its own pass statistics
+					pass2=(-pass 2 -passlogfile "$workdir/ffmpeg2pass-$n")
+					if [ "$single_pass" = true ]
 					then
-						mbit="${bitrate[$j]}"
-						mbitmax=$(( mbit*bitrate_maxratio ))
-						scaled_height=$(( height*res/width ))
-						
-						videofile="$res-$vformat."
-						
-						for k in "${!video_format_extensions[@]}"
-						do
-							if [ "${video_format_extensions[k]}" = "$vformat" ]
-							then
-								videofile+="${video_format_extensions[k+1]}"
-								break
-							fi
-						done
-						
-						[ -s "$topdir/_site/$url/$videofile" ] && continue
-						
-						output_url=$(winpath "$topdir/_site/$url/$videofile")
-						nullpath=$(winpath "/dev/null")
-						
-						echo -e "\tEncoding $vformat $res x $scaled_height"
-						
-						# h265 2 pass encode
-						if [ "$vformat" = "h265" ]
-						then
-							if [ "$firstpass" = false ]
-							then
-								firstpass=true # only need to do first pass once
-								ffmpeg -loglevel error -nostdin -y -i "$filepath" -c:v libx265 -threads "$ffmpeg_threads" $options $filtersfull -pix_fmt yuv420p -preset "$h264_encodespeed" -b:v "$mbit"M -maxrate "$mbitmax"M -bufsize "$mbitmax"M -pass 1 -an -f mp4 "$nullpath" || continue 2 # if we can't encode the video, skip this file entirely. Possibly not a video file
-							fi
-							
-							ffmpeg -loglevel error -nostdin -i "$filepath" -c:v libx265 -threads "$ffmpeg_threads" $options -vf scale="$res:trunc(ow/a/2)*2$filters" -pix_fmt yuv420p -preset "$h264_encodespeed" -b:v "$mbit"M -maxrate "$mbitmax"M -bufsize "$mbitmax"M -pass 2 "$audio" -movflags +faststart -f mp4 "$output_url"
-						
-						# h264 2 pass encode
-						elif [ "$vformat" = "h264" ]
+						twopass=false
+						pass2=()
+					fi
+					
+					hwcodec=""
+					if [ "$vformat" = "h264" ]
+					then
+						hwcodec="$h264_hwencoder"
+						profile="high"
+					elif [ "$vformat" = "h265" ]
+					then
+						hwcodec="$h265_hwencoder"
+						profile="main"
+					fi
+					
+					# encoder speed for this output, large resolutions are capped to a faster setting with adaptive_encodespeed
+					x264_preset="$h264_encodespeed"
+					vpx_speed="$vp9_encodespeed"
+					if [ "$adaptive_encodespeed" = true ] && [ "$res" -ge 1920 ]
+					then
+						if [ "$res" -ge 3840 ]
 						then
-							if [ "$firstpass" = false ]
-							then
-								firstpass=true # only need to do first pass once
-								ffmpeg -loglevel error -nostdin -y -i "$filepath" -c:v libx264 -threads "$ffmpeg_threads" $options $filtersfull -profile:v high -pix_fmt yuv420p -preset "$h264_encodespeed" -b:v "$mbit"M -maxrate "$mbitmax"M -bufsize "$mbitmax"M -pass 1 -an -f mp4 "$nullpath" || continue 2 # if we can't encode the video, skip this file entirely. Possibly not a video file
-							fi
-							
-							ffmpeg -loglevel error -nostdin -i "$filepath" -c:v libx264 -threads "$ffmpeg_threads" $options -vf scale="$res:trunc(ow/a/2)*2$filters"  -profile:v high -pix_fmt yuv420p -preset "$h264_encodespeed" -b:v "$mbit"M -maxrate "$mbitmax"M -bufsize "$mbitmax"M -pass 2 $audio -movflags +faststart -f mp4 "$output_url"
+							preset_cap="fast"
+							speed_cap=4
+						else
+							preset_cap="medium"
+							speed_cap=2
+						fi
 						
-						# VP9 2 pass encode
-						elif [ "$vformat" = "vp9" ]
+						# only move to the cap if the configured preset is slower, ie. comes after it in this list
+						presets=",ultrafast,superfast,veryfast,faster,fast,medium,slow,slower,veryslow,placebo,"
+						[[ ",${presets#*,$preset_cap,}" == *",$x264_preset,"* ]] && x264_preset="$preset_cap"
+						[ "$vpx_speed" -lt "$speed_cap" ] && vpx_speed="$speed_cap"
+					fi
+					
+					# settings for this output: codec options, the constant quality rate control used instead of the bitrate when encoding in a single pass,
+					# extra options for either pass and the muxer options. All outputs are then added the same way
+					quality=()
+					pass1speed=()
+					pass2speed=()
+					audiocodec="copy" # mp4 takes the source audio as is, webm and ogv can't hold a camera's AAC so it is re-encoded
+					
+					if [ -n "$hwcodec" ]
+					then
+						# h264/h265 1 pass hardware encode
+						twopass=false
+						pass2=()
+						if [ "$hwencoder" = "nvenc" ]
 						then
-							if [ "$firstpass" = false ]
-							then
-								firstpass=true # only need to do first pass once
-								ffmpeg -loglevel error -nostdin -y -i "$filepath" -c:v libvpx-vp9 -threads "$ffmpeg_threads" $options $filtersfull -pix_fmt yuv420p -speed 4 -b:v "$mbit"M -maxrate "$mbitmax"M -bufsize "$mbitmax"M -pass 1 -an -f webm "$nullpath" || continue 2 # if we can't encode the video, skip this file entirely. Possibly not a video file
-							fi
-							
-							ffmpeg -loglevel error -nostdin -i "$filepath" -c:v libvpx-vp9 -threads "$ffmpeg_threads" $options -vf scale="$res:trunc(ow/a/2)*2$filters" -pix_fmt yuv420p -speed "$vp9_encodespeed" -b:v "$mbit"M -maxrate "$mbitmax"M -bufsize "$mbitmax"M -pass 2 $audio -f webm "$output_url"
-						
-						# VP8 2 pass encode
-						elif [ "$vformat" = "vp8" ]
+							case "$h264_encodespeed" in
+								ultrafast|superfast) nvenc_preset="p1" ;;
+								veryfast|faster) nvenc_preset="p3" ;;
+								fast|medium) nvenc_preset="p4" ;;
+								slow) nvenc_preset="p6" ;;
+								*) nvenc_preset="p7" ;;
+							esac
+							codec=(-c:v "$hwcodec" -preset "$nvenc_preset" -tune hq -rc vbr -profile:v "$profile" -pix_fmt yuv420p)
+						elif [ "$hwencoder" = "qsv" ]
 						then
-							if [ "$firstpass" = false ]
-							then
-								firstpass=true # only need to do first pass once
-								ffmpeg -loglevel error -nostdin -y -i "$filepath" -c:v libvpx -threads "$ffmpeg_threads" $options $filtersfull -pix_fmt yuv420p -b:v "$mbit"M -maxrate "$mbitmax"M -bufsize "$mbitmax"M -pass 1 -an -f webm "$nullpath" || continue 2 # if we can't encode the video, skip this file entirely. Possibly not a video file
-							fi
-							
-							ffmpeg -loglevel error -nostdin -i "$filepath" -c:v libvpx -threads "$ffmpeg_threads" $options -vf scale="$res:trunc(ow/a/2)*2$filters" -pix_fmt yuv420p -b:v "$mbit"M -maxrate "$mbitmax"M -bufsize "$mbitmax"M -pass 2 $audio -f webm "$output_url"
-						
-						# Theora 1 pass encode
-						elif [ "$vformat" = "ogv" ]
+							codec=(-c:v "$hwcodec" -preset "$h264_encodespeed" -profile:v "$profile" -pix_fmt nv12)
+						elif [ "$hwencoder" = "vaapi" ]
 						then
-							ffmpeg -loglevel error -nostdin -i "$filepath" -c:v libtheora -threads "$ffmpeg_threads" $options -vf scale="$res:trunc(ow/a/2)*2$filters" -pix_fmt yuv420p -b:v "$mbit"M -maxrate "$mbitmax"M -bufsize "$mbitmax"M $audio "$output_url"
+							upload="format=nv12,hwupload"
+							codec=(-c:v "$hwcodec" -profile:v "$profile")
+						else
+							codec=(-c:v "$hwcodec" -profile:v "$profile" -pix_fmt yuv420p)
 						fi
+						container=(-movflags +faststart -f mp4)
+					else
+						case "$vformat" in
+							h265)
+								codec=(-c:v libx265 -threads "$output_threads" -pix_fmt yuv420p -preset "$x264_preset")
+								quality=(-crf 28 -maxrate "$mbitmax"M -bufsize "$mbitmax"M)
+								container=(-movflags +faststart -f mp4)
+								;;
+							h264)
+								codec=(-c:v libx264 -threads "$output_threads" -profile:v high -pix_fmt yuv420p -preset "$x264_preset")
+								quality=(-crf 23 -maxrate "$mbitmax"M -bufsize "$mbitmax"M)
+								container=(-movflags +faststart -f mp4)
+								;;
+							vp9)
+								codec=(-c:v libvpx-vp9 -threads "$output_threads" -pix_fmt yuv420p)
+								quality=(-crf 31 -b:v "$mbit"M)
+								pass1speed=(-speed 4)
+								pass2speed=(-speed "$vpx_speed")
+								audiocodec="libopus"
+								container=(-f webm)
+								;;
+							vp8)
+								codec=(-c:v libvpx -threads "$output_threads" -pix_fmt yuv420p)
+								quality=(-crf 10 -b:v "$mbit"M)
+								audiocodec="libopus"
+								container=(-f webm)
+								;;
+							ogv)
+								# Theora is always encoded in 1 pass at the target bitrate
+								twopass=false
+								pass2=()
+								codec=(-c:v libtheora -threads "$output_threads" -pix_fmt yuv420p)
+								audiocodec="libvorbis"
+								container=()
+								;;
+							*)
+								continue
+								;;
+						esac
 					fi
+					
+					if [ "$twopass" = false ] && [ "${#quality[@]}" -gt 0 ]
+					then
+						rate=("${quality[@]}")
+					fi
+					
+					# all outputs are written by one ffmpeg process, so each gets audio its container accepts. One output failing would stop the others
+					output_audio=("${audio[@]}")
+					[ "$disable_audio" = true ] || output_audio=(-map "0:a?" -c:a "$audiocodec")
+					
+					codec+=($options "${rate[@]}")
+					[ "$twopass" = true ] && firstpass+=(-map "[v$n]" "${codec[@]}" "${pass1speed[@]}" "${pass1[@]}" -an -f null -)
+					secondpass+=(-map "[v$n]" "${codec[@]}" "${pass2speed[@]}" "${pass2[@]}" "${output_audio[@]}" "${container[@]}" "${output_urls[n]}")
+					
+					[ "$twopass" = true ] && firstpass_scales+=("$n:$res")
+					secondpass_scales+=("$n:$res${upload:+:$upload}")
 				done
-			done
+				
+				if [ "${#firstpass[@]}" -gt 0 ]
+				then
+					ffmpeg -loglevel error -nostdin -y -i "$filepath" -filter_complex "$(scale_graph "$filters" "${firstpass_scales[@]}")" "${firstpass[@]}" || return # if we can't encode the video, skip this file entirely. Possibly not a video file
+				fi
+				
+				# let ffmpeg pick a hardware decoder for the hardware encode, it falls back to software decoding on its own
+				hwaccel=()
+				if [ "$hwencoder" = "vaapi" ]
+				then
+					hwaccel=(-vaapi_device "$vaapi_device" -hwaccel auto)
+				elif [ -n "$hwencoder" ]
+				then
+					hwaccel=(-hwaccel auto)
+				fi
+				
+				if [ "${#secondpass[@]}" -gt 0 ]
+				then
+					ffmpeg -loglevel error -nostdin -y "${hwaccel[@]}" -i "$filepath" -filter_complex "$(scale_graph "$filters" "${secondpass_scales[@]}")" "${secondpass[@]}"
+				fi
+			fi
 		fi
 		
 		output_url=""
+		output_urls=()
 		
-		ffmpeg -loglevel error -nostdin -y -i "$filepath" $options -vf "select=gte(n\,1)$filters" -vframes 1 -qscale:v 2 "$scratchdir/temp.jpg"
-		image="$scratchdir/temp.jpg"
+		# the frame extracted while reading files is the same image when there are no options or filters, don't decode the video again
+		if [ "${gallery_type[i]}" = 1 ] && [ -z "$options" ] && [ -z "$filters" ] && [ -s "$scratchdir/frame-$i.jpg" ]
+		then
+			image="$scratchdir/frame-$i.jpg"
+		else
+			ffmpeg -loglevel error -nostdin -y -i "$filepath" $options -vf "select=gte(n\,1)$filters" -vframes 1 -qscale:v 2 "$workdir/temp.jpg"
+			image="$workdir/temp.jpg"
+		fi
 	fi
 	
-	# generate static images for each resolution
-	width=$(identify -format "%w" "$image")
+	# generate static images for each resolution, the width of a photo is already known from reading files
+	if [ "${gallery_type[i]}" = 0 ] && [ -n "${gallery_width[i]}" ]
+	then
+		width="${gallery_width[i]}"
+	else
+		width=$(identify -ping -format "%w\n" "$image" | head -n 1)
+	fi
 	
 	options=""
 	if [ ! -z "${gallery_image_options[i]}" ]
@@ -936,6 +1614,7 @@ do
 	fi
 	
 	count=0
+	outputs=()
 	
 	for res in "${resolution[@]}"
 	do
@@ -945,35 +1624,156 @@ do
 		# only downscale original image
 		if [ "$width" -ge "$res" ] || [ "$count" -eq "${#resolution[@]}" ]
 		then
-			convert $autorotateoption -size "$res"x"$res" "$image" -resize "$res"x"$res" -quality "$jpeg_quality" +profile '*' $options "$topdir/_site/$url/$res.jpg"
+			outputs+=("$res")
 		fi
 	done
 	
+	# vipsthumbnail shrinks on load and always auto-rotates, so only use it when ImageMagick has nothing else to do
+	if [ "${#outputs[@]}" -gt 0 ] && [ "$vips_enabled" = true ] && [ -z "$options" ] && [ "$autorotate" = true ]
+	then
+		for res in "${outputs[@]}"
+		do
+			vipsthumbnail "$image" --size "$res"x"$res" -o "$topdir/_site/$url/$res.jpg[Q=$jpeg_quality,strip]"
+		done
+	
+	# decode the source once into an in-memory register and write every resolution from that copy
+	elif [ "${#outputs[@]}" -gt 0 ]
+	then
+		maxres="${outputs[0]}" # outputs are in resolution order, largest first
+		
+		# jpeg:size lets libjpeg scale down while decoding, 2x the largest output keeps the resize quality
+		# an animated GIF is read as its first frame, otherwise every frame would be resized and written as a numbered jpg set
+		first_frame="$image"
+		case "$image" in
+			*.[gG][iI][fF]) first_frame="$image[0]" ;;
+		esac
+		
+		# -delete 0--1 empties the image list after each write, so nothing is carried into the next resolution
+		convertargs=(-define jpeg:size=$((maxres*2))x$((maxres*2)) "$first_frame" "${autorotateoption[@]}" -quality "$jpeg_quality" +profile '*' -write mpr:orig -delete 0--1)
+		for res in "${outputs[@]}"
+		do
+			convertargs+=(mpr:orig -resize "$res"x"$res" $options -write "$topdir/_site/$url/$res.jpg" -delete 0--1)
+		done
+		
+		convert "${convertargs[@]}" null:
+	fi
+	
 	# write zip file
 	if [ "$download_button" = true ] && [ ! -e "$topdir/_site/$url/${gallery_url[i]}.zip" ]
 	then
-		mkdir "$scratchdir/zip"
+		mkdir "$workdir/zip"
 		
 		if [ "${gallery_type[i]}" = 2 ]
 		then
-			filezip="$sequencevideo"
+			# the lossless intermediate is far too large to offer, use the largest encode in the preferred format instead
+			filezip=""
+			zipres=0
+			for res in "${resolution[@]}"
+			do
+				for f in "$topdir/_site/$url/$res-${video_formats[0]}".*
+				do
+					if [ -s "$f" ] && [ "$res" -gt "$zipres" ]
+					then
+						filezip="$f"
+						zipres="$res"
+					fi
+				done
+			done
 		else
 			filezip="${gallery_files[i]}"
 		fi
 		
-		filename=$(basename "$filezip")
-		cp "${gallery_files[i]}" "$scratchdir/zip/$filename"
-		echo "$download_readme" > "$scratchdir/zip/readme.txt"
+		echo "$download_readme" > "$workdir/zip/readme.txt"
+		
+		chmod -R 740 "$workdir/zip"
 		
-		chmod -R 740 "$scratchdir/zip"
+		# add the file from where it is rather than copying it first. Photos and videos are already compressed, so store them instead of deflating them again
+		if [ -n "$filezip" ]
+		then
+			zip -j -0 "$topdir/_site/$url/${gallery_url[i]}.zip" "$filezip" "$workdir/zip/readme.txt"
+		fi
+	fi
+}
+
+# $1: index into the gallery arrays
+# true when $1 is a photo and every file encode_item would write for it already exists. Uses the width read while reading files, so nothing is run
+photo_done () {
+	[ "${gallery_type[$1]}" = 0 ] && [ -n "${gallery_width[$1]}" ] || return 1
+	
+	photo_url="$topdir/_site/${nav_url[${gallery_nav[$1]}]}/${gallery_url[$1]}"
+	
+	if [ "$download_button" = true ] && [ ! -e "$photo_url/${gallery_url[$1]}.zip" ]
+	then
+		return 1
+	fi
+	
+	# same rule as the encode: only downscale, but always write the last resolution
+	photo_count=0
+	for photo_res in "${resolution[@]}"
+	do
+		((photo_count++))
+		if [ "${gallery_width[$1]}" -ge "$photo_res" ] || [ "$photo_count" -eq "${#resolution[@]}" ]
+		then
+			[ -e "$photo_url/$photo_res.jpg" ] || return 1
+		fi
+	done
+}
+
+printf "\nStarting encode\n"
+
+# photos are started first, videos and image sequences after them so a video waiting for a video slot doesn't hold up the photos
+encode_order=()
+remaining=0 # videos and sequences left to start
+for i in "${!gallery_files[@]}"
+do
+	# photos with every output in place from an earlier run aren't started at all
+	if [ "${gallery_type[i]}" = 0 ] && ! photo_done "$i"
+	then
+		encode_order+=("$i")
+	fi
+done
+for i in "${!gallery_files[@]}"
+do
+	if [ "${gallery_type[i]}" != 0 ]
+	then
+		encode_order+=("$i")
+		((remaining++))
+	fi
+done
+
+video_pids=()
+for i in "${encode_order[@]}"
+do
+	# wait for a free encode slot
+	wait_for_slot
+	
+	if [ "${gallery_type[i]}" != 0 ]
+	then
+		wait_for_video_slot
 		
-		cd "$scratchdir/zip" && zip -r "$topdir/_site/$url/${gallery_url[i]}.zip" ./
-		cd "$topdir"
+		# several ffmpeg processes each using every core just thrash, give each encode its share
+		# once fewer videos than video slots are left, the last ones get the spare cores
+		if [ "$auto_threads" = true ]
+		then
+			running=$(( remaining < video_jobs ? remaining : video_jobs ))
+			[ "$running" -gt "$encode_jobs" ] && running="$encode_jobs"
+			ffmpeg_threads=$(( cpu_count / running ))
+			[ "$ffmpeg_threads" -lt 1 ] && ffmpeg_threads=1
+		fi
+		((remaining--))
 	fi
 	
-	rm -rf "${scratchdir:?}/"*
+	workdir=$(mktemp -d "$scratchdir/item.XXXXXX")
+	encode_item "$i" "$workdir" < /dev/null &
+	
+	if [ "${gallery_type[i]}" != 0 ]
+	then
+		video_pids+=("$!")
+	fi
 done
 
+wait
+
 # copy resources to _site
 rsync -av --exclude="template.html" --exclude="post-template.html" "$scriptdir/$theme_dir/" "$topdir/_site/" >/dev/null
 